@@ -33,9 +33,155 @@ from datetime import datetime
 import shutil
 import email
 from email.header import decode_header
-from email import message_from_bytes
+from email.parser import BytesHeaderParser
 import os
 import time
+import socket
+import ssl
+import signal
+import queue
+import threading
+import itertools
+import sqlite3
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # Motore di regex opzionale con tempo di ricerca lineare (google-re2 / pyre2)
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    # Motore opzionale che cerca più regex con una sola scansione del testo
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# Numero di messaggi richiesti con un singolo comando FETCH durante la ricerca
+FETCH_BATCH_SIZE = 100
+
+# Numero di messaggi completi scaricati con un singolo FETCH durante l'archiviazione
+ARCHIVE_FETCH_BATCH_SIZE = 20
+
+# Dimensione complessiva massima (byte, secondo RFC822.SIZE) dei messaggi
+# scaricati con un singolo FETCH durante l'archiviazione; un messaggio più
+# grande viene scaricato da solo
+ARCHIVE_FETCH_BATCH_BYTES = 8 * 1024 * 1024
+
+# Numero massimo di comandi FETCH inviati senza attendere la risposta
+FETCH_PIPELINE_DEPTH = 4
+
+# Blocchi di header scaricati in attesa di essere analizzati
+SCAN_QUEUE_SIZE = 8
+
+# Cache locale degli header scaricati (opzione --cache)
+HEADER_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                 'imaputils', 'hdr.db')
+
+# Header sempre scaricati con --cache, anche se non usati dai filtri, perché
+# le esecuzioni successive con filtri diversi trovino gli header in cache
+CACHED_HEADER_FIELDS = ('SUBJECT', 'DATE', 'FROM', 'TO', 'CC', 'SENDER', 'REPLY-TO', 'LIST-ID')
+
+# Connessioni IMAP parallele usate per scaricare gli header: molti server
+# limitano le connessioni contemporanee per utente
+DEFAULT_CONNECTIONS = 4
+MAX_CONNECTIONS = 8
+
+# Contesto TLS condiviso da tutte le connessioni: verifica il certificato
+# del server e il nome host con le CA di sistema
+SSL_CONTEXT = ssl.create_default_context()
+
+# Sessione TLS della prima connessione, ripresa dalle connessioni aggiuntive
+_tls_session = None
+
+# Secondi di inattività dopo i quali si invia un NOOP sulla connessione
+# principale mentre lavorano le connessioni aggiuntive
+KEEPALIVE_INTERVAL = 60
+
+# UID del messaggio in una risposta FETCH, es. b'12 (UID 4827 BODY[HEADER] {345}'
+_FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+
+# Dimensione del messaggio in una risposta FETCH, es. b'12 (UID 4827 RFC822.SIZE 5120)'
+_FETCH_SIZE_RE = re.compile(rb'\bRFC822\.SIZE (\d+)')
+
+# Lunghezza massima di un insieme di sequenza (es. '1:3,7,10:15') in un singolo
+# comando, per restare sotto il limite di dimensione delle richieste dei server
+MAX_SEQUENCE_SET_LENGTH = 8000
+
+# Caratteri non ammessi nei nomi dei file .eml archiviati su disco
+_FILENAME_TRANS = str.maketrans({char: '_' for char in '<>:"/\\|?*'})
+
+# Cartelle IMAP di cui è già nota l'esistenza, per non ripetere LIST e CREATE
+_folder_exists_cache = set()
+
+# Stringhe distinte (oggetti, date) di cui si conserva la decodifica
+DECODE_CACHE_SIZE = 4096
+
+# Riga vuota che separa gli header dal corpo del messaggio
+_HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+# Riga di una risposta LIST (RFC 3501), es. b'(\\HasNoChildren) "/" "INBOX/Sent"'
+# o b'(\\Noselect) NIL ""' per i server senza gerarchia di cartelle
+_LIST_RE = re.compile(rb'\((?P<flags>[^)]*)\) (?:"(?P<delim>(?:\\.|[^"\\])*)"|NIL) (?P<name>.+)', re.I)
+
+# Dimensione massima dei blocchi con cui si ritenta un COPY rifiutato dal
+# server; i blocchi vengono poi dimezzati fino al singolo messaggio
+COPY_RETRY_CHUNK_SIZE = 500
+
+# Codici di risposta (RFC 3501, RFC 5530) con cui il server rifiuta la
+# cartella di destinazione di un COPY/MOVE, non i singoli messaggi
+_MAILBOX_ERROR_RE = re.compile(rb'\[(?:TRYCREATE|NONEXISTENT)\]', re.I)
+
+# Oltre questo numero di messaggi candidati si chiede conferma prima di
+# scaricarne gli header
+LARGE_SCAN_THRESHOLD = 10000
+
+# Numero di messaggi in una risposta ESEARCH, es. b'(TAG "A5") COUNT 42'
+_ESEARCH_COUNT_RE = re.compile(rb'\bCOUNT (\d+)')
+
+# Parser degli header (senza corpo del messaggio), creato una sola volta
+_HDR_PARSER = BytesHeaderParser()
+
+# Campo "Nome: valore" di un blocco di header, con le eventuali righe di
+# continuazione che iniziano con uno spazio (RFC 5322)
+_HEADER_FIELD_RE = re.compile(rb'^([^:\s]+)[ \t]*:[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)', re.M)
+
+# Interruzione di riga seguita da spazio: continuazione di un header (RFC 5322)
+_FOLDING_RE = re.compile(r'\r?\n(?=[ \t])')
+
+# Costrutti che cambiano significato se la regex viene inserita in
+# un'alternanza multi-riga: ancore, riferimenti all'indietro, lookbehind
+_NOT_COMBINABLE_RE = re.compile(r'\^|\\[AZ1-9]|\(\?P=|\(\?<')
+
+# Gruppo con quantificatore illimitato a sua volta ripetuto, es. (a+)+ o (\w*x)*
+_NESTED_QUANTIFIER_RE = re.compile(r'\((?:\\.|[^()\\])*(?:[+*]|\{\d*,\})(?:\\.|[^()\\])*\)(?:[+*]|\{\d*,\})')
+
+# Tempo massimo (secondi) per valutare le regex dell'utente su un messaggio
+# quando re2 non è disponibile
+REGEX_TIME_LIMIT = 1.0
+
+# Larghezza del terminale usata dalla barra di avanzamento (None = da rileggere)
+_terminal_width = None
+
+# Intervallo minimo in secondi tra due aggiornamenti della barra di avanzamento
+PROGRESS_REDRAW_INTERVAL = 0.1
+
+# Messaggi usati per misurare la selettività delle condizioni -a/-o prima di
+# riordinarle
+SELECTIVITY_SAMPLE_SIZE = 200
+
+# Header che secondo RFC 5322 compaiono al più una volta in un messaggio; Date
+# è escluso perché i filtri lo confrontano nel formato normalizzato
+# '%Y-%m-%d %H:%M:%S', diverso dal valore grezzo cercato dal server
+_SINGLE_HEADERS = frozenset(('from', 'sender', 'reply-to', 'to', 'cc', 'bcc',
+                             'message-id', 'in-reply-to', 'references', 'subject'))
+
+# Caratteri che rendono una regex qualcosa di più di una semplice sottostringa
+_REGEX_METACHARS = '.^$*+?{}[]|()'
+
 
 def print_help():
     """
@@ -81,6 +227,10 @@ Parametri:
 
 --archive: Specifica la cartella IMAP di destinazione per l'archiviazione dei messaggi
 --archive-to-disk: Specifica la cartella locale di destinazione per l'archiviazione dei messaggi
+--connections: Numero di connessioni IMAP parallele usate per la ricerca (default 4, massimo 8)
+--parse-workers: Numero di processi che analizzano gli header durante la ricerca (default 0, nessuno)
+--fetch-batch-size: Numero di messaggi richiesti con ogni FETCH durante la ricerca (default 100)
+--cache: Conserva su disco gli header scaricati e li riusa nelle esecuzioni successive
 --debug: Abilita i messaggi di debug
 
 Per ulteriori informazioni su un parametro specifico, digita il nome del parametro (es. '-u'):
@@ -112,14 +262,41 @@ Per ulteriori informazioni su un parametro specifico, digita il nome del paramet
             print("--archive-to-disk: Specifica la cartella locale di destinazione per l'archiviazione dei messaggi. "
                   "I messaggi verranno archiviati in una struttura di cartelle locale organizzata per anno e mese. "
                   "Con questa opzione, i messaggi vengono archiviati localmente e spostati nel cestino, a meno che non sia presente il flag -e.")
+        elif user_input == '--connections':
+            print("--connections: Numero di connessioni IMAP aperte in parallelo per scaricare gli header durante la ricerca "
+                  "(default 4, massimo 8). Ridurlo se il server limita le connessioni contemporanee.")
+        elif user_input == '--parse-workers':
+            print("--parse-workers: Numero di processi separati che analizzano gli header e applicano le regex durante la ricerca "
+                  "(default 0: l'analisi avviene nel processo principale). Utile su cartelle molto grandi con filtri complessi.")
+        elif user_input == '--fetch-batch-size':
+            print("--fetch-batch-size: Numero di messaggi di cui si scaricano gli header con un singolo comando FETCH "
+                  "(default 100). Valori più alti riducono i round trip, ma alcuni server limitano la lunghezza dei comandi.")
+        elif user_input == '--cache':
+            print("--cache: Salva gli header scaricati in una cache locale (~/.cache/imaputils/hdr.db). "
+                  "Nelle esecuzioni successive sulla stessa cartella vengono scaricati solo gli header dei messaggi nuovi.")
         elif user_input == '--debug':
             print("--debug: "
                   "Attiva modalità debug. "
                   )
         else:
-            print("Parametro non riconosciuto. Prova con -u, -s, -p, -l, -f, -d, -e, --archive, o --archive-to-disk.")
+            print("Parametro non riconosciuto. Prova con -u, -s, -p, -l, -f, -d, -e, --archive, --archive-to-disk, "
+                  "--connections, --parse-workers, --fetch-batch-size, --cache o --debug.")
         print("\nInserisci un altro parametro o 'q' per uscire:")
 
+def prewarm_folder_cache(imap):
+    # Un solo LIST di tutte le cartelle evita le verifiche per ogni livello
+    # del percorso in create_imap_folder
+    res, folders = imap.list('""', '*')
+    if res != 'OK':
+        return
+    for folder in folders:
+        if isinstance(folder, tuple):
+            _folder_exists_cache.add(folder[1].decode())
+            continue
+        match = _LIST_RE.match(folder or b'')
+        if match:
+            _folder_exists_cache.add(match['name'].decode().strip('"'))
+
 def create_imap_folder(imap, folder_name, user, debug=False):
     if debug:
         print(f"DEBUG: Tentativo di creare la cartella: {folder_name}")
@@ -140,6 +317,8 @@ def create_imap_folder(imap, folder_name, user, debug=False):
             if current_path:
                 current_path += '/'
             current_path += part
+            if current_path in _folder_exists_cache:
+                continue
             if debug:
                 print(f"DEBUG: Verifica/creazione del percorso: {current_path}")
 
@@ -159,7 +338,9 @@ def create_imap_folder(imap, folder_name, user, debug=False):
                 if res != 'OK':
                     print(f"Errore nella creazione della cartella {current_path}")
                     return False
+                _folder_exists_cache.add(current_path)
             else:
+                _folder_exists_cache.add(current_path)
                 if debug:
                     print(f"DEBUG: La cartella {current_path} esiste già")
                     print(f"DEBUG: {folders} {type(folders)}")
@@ -180,29 +361,38 @@ def create_imap_folder(imap, folder_name, user, debug=False):
 
 
 def get_hierarchy_delimiter(imap):
-    result, data = imap.list()
-    if result == 'OK':
-        # Esempio di risposta: '("*" "." "")'
-        # Estrai il delimitatore di gerarchia dalla risposta
-        hierarchy_delimiter = data[0].decode().split(' ')[2].strip('"')
-        print(f"Delimitatore di gerarchia: {hierarchy_delimiter}")
+    # LIST "" "" restituisce solo il delimitatore (RFC 3501, 6.3.8)
+    result, data = imap.list('""', '""')
+    match = _LIST_RE.match(data[0]) if result == 'OK' and data and isinstance(data[0], bytes) else None
+    if match:
+        # Esempio di risposta: '(\Noselect) "." ""'; NIL se non c'è gerarchia
+        delimiter = match['delim'] or b''
+        hierarchy_delimiter = delimiter.decode().replace('\\\\', '\\').replace('\\"', '"')
+        print(f"Delimitatore di gerarchia: {hierarchy_delimiter or 'nessuno'}")
     else:
         print("Impossibile ottenere il delimitatore di gerarchia dal server IMAP.")
         hierarchy_delimiter = '/'
     return hierarchy_delimiter
 
 
-def archive_message_imap(imap, msg_id, dest_folder, source_folder, user, debug=False):
+@lru_cache(maxsize=DECODE_CACHE_SIZE)
+def parsedate_tz_cached(value):
+    # Nei messaggi inviati in massa la stessa data si ripete
+    return email.utils.parsedate_tz(value)
+
+def parse_message_headers(raw_message):
+    # Per il percorso e il nome del file servono solo Date e Subject: si
+    # analizza la sola sezione degli header, senza costruire le parti MIME
+    header_end = _HEADER_END_RE.search(raw_message)
+    if header_end:
+        raw_message = raw_message[:header_end.start()]
+    return _HDR_PARSER.parsebytes(raw_message)
+
+def archive_message_imap(imap, msg_id, email_body, dest_folder, source_folder, user, debug=False):
     if debug:
         print(f"DEBUG: Inizio archiviazione del messaggio {msg_id}")
-    res, msg_data = imap.fetch(msg_id, '(RFC822)')
-    if res != 'OK':
-        print(f"Errore nel recupero del messaggio {msg_id}")
-        return False
-
-    email_body = msg_data[0][1]
-    email_message = message_from_bytes(email_body)
-    date_tuple = email.utils.parsedate_tz(email_message['Date'])
+    email_message = parse_message_headers(email_body)
+    date_tuple = parsedate_tz_cached(email_message['Date'])
     
     source_folder_name = os.path.basename(source_folder.strip('"'))
     if debug:
@@ -221,12 +411,6 @@ def archive_message_imap(imap, msg_id, dest_folder, source_folder, user, debug=F
             print(f"DEBUG: Fallimento nella creazione della cartella {archive_path}")
         return False
     
-    # Verifica se la cartella esiste prima di tentare l'append
-    res, _ = imap.list(f'"{archive_path}"')
-    if res != 'OK':
-        print(f"Errore: La cartella {archive_path} non esiste o non è accessibile")
-        return False
-    
     if debug:
         print(f"DEBUG: Tentativo di append del messaggio in {archive_path}")
     #res = imap.append(f'"{archive_path}"', '', imaplib.Time2Internaldate(time.time()), email_body)
@@ -238,18 +422,12 @@ def archive_message_imap(imap, msg_id, dest_folder, source_folder, user, debug=F
 
 
 
-def archive_message_disk(msg_id, imap, dest_folder, source_folder, debug=False):
+def archive_message_disk(msg_id, email_body, dest_folder, source_folder, debug=False):
     if debug:
         print(f"DEBUG: Inizio archiviazione su disco del messaggio {msg_id}")
     
-    res, msg_data = imap.fetch(msg_id, '(RFC822)')
-    if res != 'OK':
-        print(f"Errore nel recupero del messaggio {msg_id}")
-        return False
-
-    email_body = msg_data[0][1]
-    email_message = email.message_from_bytes(email_body)
-    date_tuple = email.utils.parsedate_tz(email_message['Date'])
+    email_message = parse_message_headers(email_body)
+    date_tuple = parsedate_tz_cached(email_message['Date'])
     
     if debug:
         print(f"DEBUG: Data del messaggio: {email_message['Date']}")
@@ -267,15 +445,11 @@ def archive_message_disk(msg_id, imap, dest_folder, source_folder, debug=False):
     
     os.makedirs(archive_path, exist_ok=True)
     
-    subject = email_message['Subject']
-    if subject:
-        subject = decode_mime_words(subject)
-    else:
-        subject = 'No Subject'
+    # Oggetto decodificato e senza le righe di continuazione, che finirebbero
+    # nel nome del file
+    subject = get_header_value(email_message, 'Subject') or 'No Subject'
     
-    safe_subject = re.sub(r'[<>:"/\\|?*]', '_', subject)
-    safe_filename = f"{email_message['Date']}_{safe_subject[:50]}.eml"
-    safe_filename = safe_filename.replace(':', '_')
+    safe_filename = f"{email_message['Date']}_{subject[:50]}".translate(_FILENAME_TRANS) + '.eml'
     
     file_path = os.path.join(archive_path, safe_filename)
     
@@ -283,8 +457,14 @@ def archive_message_disk(msg_id, imap, dest_folder, source_folder, debug=False):
         print(f"DEBUG: Salvataggio del messaggio in: {file_path}")
     
     try:
-        with open(file_path, 'wb') as f:
-            f.write(email_body)
+        # Scrittura unica senza il livello di buffering di open()
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            data = memoryview(email_body)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
         if debug:
             print(f"DEBUG: Messaggio salvato con successo")
         return True
@@ -301,30 +481,57 @@ def archive_message_disk(msg_id, imap, dest_folder, source_folder, debug=False):
 
 
 
-def decode_mime_words(s):
+def _join_decoded_words(words):
+    # 'unknown-8bit' indica byte non ASCII non codificati secondo RFC 2047
     return ''.join(
-        word.decode(encoding or 'utf8') if isinstance(word, bytes) else word
-        for word, encoding in decode_header(s)
+        word.decode(encoding if encoding and encoding != 'unknown-8bit' else 'utf8', errors='replace')
+        if isinstance(word, bytes) else word
+        for word, encoding in words
     )
 
+@lru_cache(maxsize=DECODE_CACHE_SIZE)
+def _decode_encoded_words(s):
+    return _join_decoded_words(decode_header(s))
+
+def decode_mime_words(s):
+    if not s:
+        return ''
+    if isinstance(s, str):
+        # Senza encoded-word non c'è nulla da decodificare (caso più comune);
+        # le altre stringhe si ripetono spesso (mailing list, notifiche) e
+        # vengono decodificate una sola volta
+        if '=?' not in s:
+            return s
+        return _decode_encoded_words(s)
+    # Oggetti Header (byte non ASCII nell'header): non hashable, niente cache
+    return _join_decoded_words(decode_header(s))
+
 def show_grouped_subjects_and_select(filtered_msgs):
-    subject_count = {}
+    subject_count = Counter()
+    subject_ids = defaultdict(list)
+    # Per ogni soggetto si tiene solo la data minima e massima, senza ordinare
+    first_date = {}
+    last_date = {}
     for msg_id, subject, date in filtered_msgs:
-        if subject not in subject_count:
-            subject_count[subject] = {'count': 0, 'ids': [], 'dates': []}
-        subject_count[subject]['count'] += 1
-        subject_count[subject]['ids'].append(msg_id)
-        subject_count[subject]['dates'].append(date)
+        # I soggetti ripetuti condividono la stessa stringa
+        subject = sys.intern(subject)
+        subject_count[subject] += 1
+        subject_ids[subject].append(msg_id)
+        if subject not in first_date:
+            first_date[subject] = last_date[subject] = date
+        elif date < first_date[subject]:
+            first_date[subject] = date
+        elif date > last_date[subject]:
+            last_date[subject] = date
     
     print(f"\nSoggetti dei messaggi trovati (totale: {len(filtered_msgs)}):")
-    subjects_list = sorted(subject_count.items(), key=lambda x: x[1]['count'], reverse=True)
-    for i, (subject, data) in enumerate(subjects_list, 1):
-        dates = sorted(data['dates'])
-        if len(dates) > 1:
-            date_info = f"dal {dates[0]} al {dates[-1]}"
+    subjects_list = subject_count.most_common()
+    for i, (subject, count) in enumerate(subjects_list, 1):
+        if count > 1:
+            date_info = f"dal {first_date[subject]} al {last_date[subject]}"
         else:
-            date_info = f"il {dates[0]}"
-        print(f"{i}. {subject} ({data['count']} messaggi) - {date_info}")
+            date_info = f"il {first_date[subject]}"
+        print(f"{i}. {subject} ({count} messaggi) - {date_info}")
     
     selected_groups = []
     while True:
@@ -346,47 +553,86 @@ def show_grouped_subjects_and_select(filtered_msgs):
     
     messages_to_delete = []
     for i in selected_groups:
-        subject, data = subjects_list[i-1]
-        messages_to_delete.extend(data['ids'])
-        print(f"Selezionato per la cancellazione: {subject} ({data['count']} messaggi)")
+        subject, count = subjects_list[i-1]
+        messages_to_delete.extend(subject_ids[subject])
+        print(f"Selezionato per la cancellazione: {subject} ({count} messaggi)")
     
     return messages_to_delete
 
 
 
 
-def create_progress_bar(total, current, matching, non_matching):
-    width, _ = shutil.get_terminal_size()
-    
+def _reset_terminal_width(signum, frame):
+    global _terminal_width
+    _terminal_width = None
+
+def terminal_width():
+    # La larghezza viene letta una sola volta e ricalcolata solo dopo un
+    # ridimensionamento del terminale (SIGWINCH)
+    global _terminal_width
+    if _terminal_width is None:
+        _terminal_width = shutil.get_terminal_size().columns
+    return _terminal_width
+
+def create_progress_bar(total, current, matching, non_matching, width):
+    # La barra è costruita direttamente in byte, preceduta da '\r', pronta per
+    # essere scritta su sys.stdout.buffer
+
     # Calcola lo spazio necessario per la percentuale e i caratteri accessori
-    percent = f" {current/total*100:.1f}%"
+    percent = b' %.1f%%' % (current / total * 100)
     extra_chars = 2  # Per le parentesi quadre []
     
     # Sottrai lo spazio per la percentuale e i caratteri accessori
     available_width = width - len(percent) - extra_chars
     
     if available_width <= 0:
-        return f"[{'*' * matching}{'_' * non_matching}{' ' * (total-current)}]{percent}"
+        return b''.join((b'\r[', b'*' * matching, b'_' * non_matching, b' ' * (total - current), b']', percent))
 
     filled = int(available_width * current // total)
     matching_width = int(available_width * matching // total)
     non_matching_width = filled - matching_width
     remaining_width = available_width - filled
 
-    matching_str = '*' * matching_width
-    non_matching_str = '_' * non_matching_width
-    remaining_str = ' ' * remaining_width
+    matching_str = b'*' * matching_width
+    non_matching_str = b'_' * non_matching_width
+    remaining_str = b' ' * remaining_width
 
     # Aggiungi i contatori se c'è spazio sufficiente
     if matching > 0 and matching_width > len(str(matching)):
-        matching_str = str(matching).center(matching_width, '*')
+        matching_str = b'%d' % matching
+        matching_str = matching_str.center(matching_width, b'*')
     if non_matching > 0 and non_matching_width > len(str(non_matching)):
-        non_matching_str = str(non_matching).center(non_matching_width, '_')
+        non_matching_str = b'%d' % non_matching
+        non_matching_str = non_matching_str.center(non_matching_width, b'_')
     if (total-current) > 0 and remaining_width > len(str(total-current)):
-        remaining_str = str(total-current).center(remaining_width, ' ')
+        remaining_str = b'%d' % (total - current)
+        remaining_str = remaining_str.center(remaining_width, b' ')
+
+    return b''.join((b'\r[', matching_str, non_matching_str, remaining_str, b']', percent))
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"'{value}' non è un numero intero positivo")
+    return number
 
-    bar = matching_str + non_matching_str + remaining_str
-    return f"[{bar}]{percent}"
+def non_negative_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"'{value}' non è un numero intero non negativo")
+    return number
+
+def connection_count(value):
+    number = positive_int(value)
+    if number > MAX_CONNECTIONS:
+        raise argparse.ArgumentTypeError(f"'{value}' supera il massimo di {MAX_CONNECTIONS} connessioni")
+    return number
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Script IMAP per gestione messaggi.')
@@ -404,9 +650,26 @@ def parse_args():
                         help='Ricerca OR nell\'header specificato usando la regex fornita')
     parser.add_argument('--archive', metavar='CARTELLA_DESTINAZIONE', help='Archivia spostandoli i messaggi nella cartella specificata')
     parser.add_argument('--archive-to-disk', metavar='CARTELLA_LOCALE_DESTINAZIONE', help='Archivia i messaggi nella cartella locale specificata')
+    parser.add_argument('--connections', metavar='N', type=connection_count, default=DEFAULT_CONNECTIONS,
+                        help=f'Numero di connessioni IMAP parallele per la ricerca (1-{MAX_CONNECTIONS}, default {DEFAULT_CONNECTIONS})')
+    parser.add_argument('--parse-workers', metavar='N', type=non_negative_int, default=0,
+                        help='Processi che analizzano gli header durante la ricerca (default 0, nel processo principale)')
+    parser.add_argument('--fetch-batch-size', metavar='N', type=positive_int, default=FETCH_BATCH_SIZE,
+                        help=f'Messaggi richiesti con ogni FETCH durante la ricerca (default {FETCH_BATCH_SIZE})')
+    parser.add_argument('--cache', action='store_true',
+                        help=f'Conserva gli header scaricati in {HEADER_CACHE_PATH} per le esecuzioni successive')
     parser.add_argument('--debug', action='store_true', help='Abilita i messaggi di debug')
     return parser.parse_args()
 
+class ResumableIMAP4_SSL(imaplib.IMAP4_SSL):
+    # Disattiva l'algoritmo di Nagle, abilita il keepalive TCP e riprende la
+    # sessione TLS già negoziata (RFC 5077) evitando un handshake completo
+    def _create_socket(self, timeout):
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=_tls_session)
+
 def connect_imap(server, username, password):
     if ':' in server:
         server_name, port = server.split(':')
@@ -416,23 +679,40 @@ def connect_imap(server, username, password):
         port = None
     try:
         if port:
-            imap = imaplib.IMAP4_SSL(server_name, port)
+            imap = ResumableIMAP4_SSL(server_name, port, ssl_context=SSL_CONTEXT)
         else:
-            imap = imaplib.IMAP4_SSL(server_name)
+            imap = ResumableIMAP4_SSL(server_name, ssl_context=SSL_CONTEXT)
         imap.login(username, password)
+        # Con TLS 1.3 il ticket di sessione arriva dopo l'handshake
+        global _tls_session
+        if _tls_session is None:
+            _tls_session = imap.sock.session
+        # Molti server annunciano le estensioni (ESEARCH, UIDPLUS...) solo dopo il login
+        res, data = imap.capability()
+        if res == 'OK' and data and data[-1]:
+            imap.capabilities = tuple(data[-1].decode().upper().split())
         return imap
     except imaplib.IMAP4.error as e:
         print(f'Errore durante la connessione al server IMAP: {e}')
         sys.exit(1)
+    except ssl.SSLCertVerificationError as e:
+        print(f'Certificato del server IMAP non valido: {e.verify_message}')
+        sys.exit(1)
 
 def list_folders(imap):
     result, folders = imap.list()
     if result == 'OK':
         print('Cartelle disponibili:')
         for folder in folders:
-            parts = folder.decode().split(' "/" ')
-            if len(parts) == 2:
-                print(parts[1].strip('"'))
+            if isinstance(folder, tuple):
+                # Nome della cartella inviato come literal
+                print(folder[1].decode())
+                continue
+            if not folder:
+                continue
+            match = _LIST_RE.match(folder)
+            if match:
+                print(match['name'].decode().strip('"'))
             else:
                 print(folder.decode())
     else:
@@ -448,20 +728,739 @@ def get_date_range(date_range_str):
         print('Formato delle date non valido. Utilizzare dd/mm/yyyy-dd/mm/yyyy.')
         sys.exit(1)
         
-def get_header_value(header_data, header_name):
-    match = re.search(f'{header_name}: (.*)', header_data, re.IGNORECASE | re.MULTILINE)
-    if match:
-        value = decode_mime_words(match.group(1).strip())
-        if header_name.lower() == 'date':
+class HeaderFields(dict):
+    # Header di un messaggio indicizzati per nome in minuscolo; get() non
+    # distingue maiuscole e minuscole come email.message.Message e decodifica
+    # i byte del valore solo quando l'header viene effettivamente letto
+    def get(self, name, default=None):
+        # I nomi già in minuscolo (HeaderClassifier) non richiedono lower()
+        value = dict.get(self, name)
+        if value is None:
+            value = dict.get(self, name.lower())
+            if value is None:
+                return default
+        if value.isascii():
+            return value.decode('ascii')
+        # Byte non ASCII non codificati secondo RFC 2047
+        return value.decode('utf-8', errors='replace')
+
+def parse_header_fields(header_data):
+    """
+    Analizza in un solo passaggio il blocco di header restituito da
+    BODY.PEEK[HEADER.FIELDS (...)], senza costruire un messaggio email.
+    Come email.message.Message.get(), per ogni nome si conserva il primo
+    valore; i valori restano in byte fino alla lettura e la decodifica
+    RFC 2047 resta a decode_mime_words.
+    """
+    fields = HeaderFields()
+    for name, value in _HEADER_FIELD_RE.findall(header_data):
+        name = name.decode('ascii', errors='replace').lower()
+        if name not in fields:
+            fields[name] = value
+    return fields
+
+def get_header_value(msg, header_name):
+    value = msg.get(header_name)
+    if not value:
+        return ''
+    # Il parser conserva le righe di continuazione degli header su più righe
+    value = decode_mime_words(value)
+    if '\n' in value:
+        value = _FOLDING_RE.sub('', value)
+    value = value.strip()
+    if header_name.lower() == 'date':
+        try:
+            # Prova a parsare la data in un formato standard
+            parsed_date = email.utils.parsedate_to_datetime(value)
+            return parsed_date.strftime('%Y-%m-%d %H:%M:%S')
+        except:
+            # Se il parsing fallisce, restituisci la stringa originale
+            return value
+    return value
+
+class RegexTimeoutError(Exception):
+    pass
+
+def _raise_regex_timeout(signum, frame):
+    raise RegexTimeoutError()
+
+@contextmanager
+def regex_time_limit(seconds):
+    # Interrompe con RegexTimeoutError il blocco che supera i secondi indicati
+    # (SIGALRM, solo nel thread principale); None disattiva il limite
+    if not seconds:
+        yield
+        return
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def compile_user_regex(pattern, multiline=False):
+    """
+    Compila una regex fornita dall'utente, senza distinzione tra maiuscole e
+    minuscole. Se è installato re2 (ricerca in tempo lineare) viene usato
+    quello; altrimenti, o se re2 non supporta la regex, si usa re rifiutando
+    i quantificatori annidati come (a+)+ che causano backtracking catastrofico.
+    """
+    if re2 is not None:
+        try:
+            return re2.compile(('(?im)' if multiline else '(?i)') + pattern)
+        except Exception:
+            # re2 non supporta lookaround e riferimenti all'indietro
+            pass
+    if _NESTED_QUANTIFIER_RE.search(pattern):
+        raise re.error(f'quantificatori annidati non ammessi, rischio di backtracking catastrofico: {pattern}')
+    return re.compile(pattern, re.IGNORECASE | (re.MULTILINE if multiline else 0))
+
+class HyperscanPatterns:
+    """
+    Regex OR compilate in un unico database hyperscan: una sola scansione
+    del testo verifica tutte le condizioni.
+    """
+
+    def __init__(self, patterns):
+        flags = (hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_MULTILINE | hyperscan.HS_FLAG_UTF8
+                 | hyperscan.HS_FLAG_UCP | hyperscan.HS_FLAG_SOM_LEFTMOST)
+        self.database = hyperscan.Database()
+        self.database.compile(expressions=[pattern.encode() for pattern in patterns],
+                              ids=list(range(len(patterns))), elements=len(patterns),
+                              flags=[flags] * len(patterns))
+
+    def search(self, text):
+        # Restituisce il testo della prima corrispondenza trovata, o None
+        data = text.encode('utf-8', errors='replace')
+        found = []
+
+        def on_match(pattern_id, start, end, flags, context):
+            found.append(data[start:end])
+            return True  # interrompe la scansione
+
+        try:
+            self.database.scan(data, match_event_handler=on_match)
+        except hyperscan.ScanTerminated:
+            pass
+        return found[0].decode('utf-8', errors='replace') if found else None
+
+def combine_or_filters(or_headers):
+    """
+    Combina le regex OR in un'unica alternanza da applicare alle righe
+    'Header: valore' dei soli header OR, con una sola ricerca per messaggio.
+    Restituisce None se le regex sono meno di due o se qualcuna non è
+    combinabile (ancore di inizio testo, riferimenti all'indietro...).
+    """
+    if len(or_headers) < 2:
+        return None
+    if any(_NOT_COMBINABLE_RE.search(regex) for _, regex in or_headers):
+        return None
+    if hyperscan:
+        try:
+            return HyperscanPatterns([f'^{re.escape(header)}: .*(?:{regex})' for header, regex in or_headers])
+        except hyperscan.error:
+            # Costrutti non supportati da hyperscan (lookahead...): si usa re
+            pass
+    try:
+        return compile_user_regex('|'.join(f'(?:^{re.escape(header)}: .*?(?:{regex}))'
+                                           for header, regex in or_headers),
+                                  multiline=True)
+    except re.error:
+        return None
+
+def match_or_filters(msg, or_filters, or_combined=None):
+    if not or_filters:
+        return True
+    if or_combined:
+        lines = '\n'.join(f'{header}: {get_header_value(msg, header)}' for header, _ in or_filters)
+        match = or_combined.search(lines)
+        if match is None:
+            return False
+        # Una corrispondenza che attraversa più righe non è valida per
+        # nessun header singolo: si verifica con le regex separate
+        if '\n' not in (match if isinstance(match, str) else match.group()):
+            return True
+    return any(regex.search(get_header_value(msg, header)) for header, regex in or_filters)
+
+def profile_filters(msg, and_filters, or_filters, and_kills, or_hits):
+    # Valuta tutte le condizioni senza cortocircuito, contando per ciascuna
+    # quante volte scarta (AND) o accetta (OR) il messaggio
+    and_results = [bool(regex.search(get_header_value(msg, header))) for header, regex in and_filters]
+    or_results = [bool(regex.search(get_header_value(msg, header))) for header, regex in or_filters]
+    for i, matched in enumerate(and_results):
+        if not matched:
+            and_kills[i] += 1
+    for i, matched in enumerate(or_results):
+        if matched:
+            or_hits[i] += 1
+    return all(and_results), any(or_results) if or_filters else True
+
+def sort_filters(filters, counts):
+    # Ordina le condizioni per conteggio decrescente, a parità mantiene l'ordine
+    order = sorted(range(len(filters)), key=lambda i: -counts[i])
+    return [filters[i] for i in order]
+
+class HeaderClassifier:
+    """
+    Applica agli header di un messaggio la regex sull'oggetto e le
+    condizioni -a/-o, compilate una sola volta.
+
+    Sui primi SELECTIVITY_SAMPLE_SIZE messaggi misura quanto è selettiva
+    ogni condizione, poi le riordina in modo da valutare per prime le AND
+    che scartano più messaggi e le OR che ne accettano di più.
+    """
+
+    def __init__(self, subject_regex, and_headers, or_headers, debug=False):
+        self.debug = debug
+        self.subject_re = compile_user_regex(subject_regex) if subject_regex else None
+        # Le condizioni AND più economiche (regex più corte) vengono valutate per
+        # prime; i nomi degli header sono convertiti una sola volta in minuscolo
+        self.and_filters = [(header.lower(), compile_user_regex(regex))
+                            for header, regex in sorted(and_headers, key=lambda h: len(h[1]))]
+        self.or_filters = [(header.lower(), compile_user_regex(regex)) for header, regex in or_headers]
+        self.or_combined = combine_or_filters(or_headers)
+
+        # Senza re2 una regex può richiedere tempo esponenziale: ogni messaggio ha
+        # un tempo massimo di valutazione, oltre il quale viene scartato
+        user_patterns = ([self.subject_re] + [regex for _, regex in self.and_filters + self.or_filters]
+                         + [self.or_combined])
+        self.time_limit = REGEX_TIME_LIMIT if hasattr(signal, 'SIGALRM') and any(
+            isinstance(pattern, re.Pattern) for pattern in user_patterns) else None
+        if self.time_limit:
+            signal.signal(signal.SIGALRM, _raise_regex_timeout)
+
+        self.profiling = len(self.and_filters) > 1 or len(self.or_filters) > 1
+        self.profiled = 0
+        self.and_kills = [0] * len(self.and_filters)
+        self.or_hits = [0] * len(self.or_filters)
+
+    def classify(self, header_data):
+        # Restituisce (oggetto, data) se il messaggio soddisfa tutti i filtri,
+        # altrimenti None; RegexTimeoutError se le regex sono troppo lente
+        msg = parse_header_fields(header_data)
+
+        with regex_time_limit(self.time_limit):
+            if self.profiling:
+                and_match, or_match = profile_filters(msg, self.and_filters, self.or_filters,
+                                                      self.and_kills, self.or_hits)
+            else:
+                # Verifica le condizioni AND
+                and_match = all(regex.search(get_header_value(msg, header))
+                                for header, regex in self.and_filters)
+
+                # Verifica le condizioni OR (solo se le AND sono soddisfatte)
+                or_match = and_match and match_or_filters(msg, self.or_filters, self.or_combined)
+
+            # Oggetto e data si decodificano solo per i messaggi non già scartati
+            matched = and_match and or_match
+            if matched:
+                subject = get_header_value(msg, 'subject')
+                matched = not self.subject_re or self.subject_re.search(subject)
+
+        if self.profiling:
+            self.profiled += 1
+            if self.profiled >= SELECTIVITY_SAMPLE_SIZE:
+                self.profiling = False
+                self.and_filters = sort_filters(self.and_filters, self.and_kills)
+                self.or_filters = sort_filters(self.or_filters, self.or_hits)
+                if self.debug:
+                    print(f"\nDEBUG: Ordine condizioni AND: {[h for h, _ in self.and_filters]}, "
+                          f"OR: {[h for h, _ in self.or_filters]}", flush=True)
+
+        if matched:
+            return subject, get_header_value(msg, 'date')
+        return None
+
+    def classify_batch(self, header_list):
+        """
+        Classifica gli header di un blocco di messaggi (None se mancante).
+        Per ogni messaggio restituisce una tupla che inizia con l'esito:
+        ('match', oggetto, data), ('nomatch',), ('missing',), ('timeout',)
+        oppure ('error', descrizione).
+        """
+        results = []
+        for header_data in header_list:
+            if header_data is None:
+                results.append(('missing',))
+                continue
             try:
-                # Prova a parsare la data in un formato standard
-                parsed_date = email.utils.parsedate_to_datetime(value)
-                return parsed_date.strftime('%Y-%m-%d %H:%M:%S')
-            except:
-                # Se il parsing fallisce, restituisci la stringa originale
-                return value
-        return value
-    return ''
+                matched = self.classify(header_data)
+            except RegexTimeoutError:
+                results.append(('timeout',))
+            except Exception as e:
+                results.append(('error', str(e)))
+            else:
+                results.append(('match', *matched) if matched else ('nomatch',))
+        return results
+
+# Classificatore di ogni processo di lavoro (opzione --parse-workers)
+_worker_classifier = None
+
+def _init_parse_worker(subject_regex, and_headers, or_headers, debug):
+    # Le regex compilate non si possono passare tra processi: ogni processo
+    # le ricompila dalle stringhe originali
+    global _worker_classifier
+    _worker_classifier = HeaderClassifier(subject_regex, and_headers, or_headers, debug)
+
+def _classify_in_worker(header_list):
+    return _worker_classifier.classify_batch(header_list)
+
+def classify_batches(header_batches, classifier, executor=None, depth=1):
+    """
+    Classifica gli header di ogni blocco e restituisce le coppie
+    (blocco, risultati di classify_batch).
+
+    Con un executor i blocchi sono analizzati nei processi di lavoro, fino a
+    depth blocchi alla volta, mentre i successivi vengono ancora scaricati.
+    """
+    pending = deque()
+    for batch, headers in header_batches:
+        header_list = [headers.get(msg_id) for msg_id in batch]
+        if executor is None:
+            yield batch, classifier.classify_batch(header_list)
+            continue
+        pending.append((batch, executor.submit(_classify_in_worker, header_list)))
+        if len(pending) >= depth:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+    while pending:
+        batch, future = pending.popleft()
+        yield batch, future.result()
+
+def literal_pattern(regex):
+    # Se la regex è una semplice sottostringa, eventualmente ancorata e con
+    # metacaratteri protetti da '\' (es. '^Re: ', 'example\.com$'),
+    # restituisce la sottostringa che deve comparire nel valore, altrimenti None
+    if not regex:
+        return None
+    literal = []
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            i += 1
+            # '\d', '\b', '\1'... non sono caratteri letterali
+            if i == len(regex) or regex[i].isalnum():
+                return None
+            literal.append(regex[i])
+        elif char in _REGEX_METACHARS:
+            if not (char == '^' and i == 0 or char == '$' and i == len(regex) - 1):
+                return None
+        else:
+            literal.append(char)
+        i += 1
+    literal = ''.join(literal)
+    return literal if literal and literal.isprintable() else None
+
+def is_exact_server_filter(header, regex):
+    # Una sottostringa ASCII senza ancore viene cercata dal server con HEADER
+    # (RFC 3501: sottostringa, senza distinzione tra maiuscole e minuscole)
+    # con lo stesso risultato della regex, che non serve riapplicare. Vale
+    # solo per gli header presenti al più una volta: il server li cerca in
+    # tutte le occorrenze, il client controlla solo la prima
+    if header.lower() not in _SINGLE_HEADERS:
+        return False
+    literal = literal_pattern(regex)
+    if not literal or not literal.isascii() or regex.startswith('^'):
+        return False
+    # '$' finale preceduto da un numero pari di '\' è un'ancora
+    backslashes = len(regex[:-1]) - len(regex[:-1].rstrip('\\'))
+    return not (regex.endswith('$') and backslashes % 2 == 0)
+
+def imap_quote(value):
+    # Stringa quotata IMAP (RFC 3501): '\' e '"' vanno protetti con '\'
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def sequence_sets(msg_ids, max_length=MAX_SEQUENCE_SET_LENGTH):
+    """
+    Comprime gli id dei messaggi in insiemi di sequenza IMAP (es. '1:3,7,10:15')
+    lunghi al massimo max_length caratteri.
+    Restituisce una lista di coppie (insieme di sequenza, numero di messaggi).
+    """
+    ranges = []
+    for n in sorted(set(int(msg_id) for msg_id in msg_ids)):
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+
+    seqsets = []
+    current, count = '', 0
+    for start, end in ranges:
+        part = str(start) if start == end else f'{start}:{end}'
+        if current and len(current) + 1 + len(part) > max_length:
+            seqsets.append((current, count))
+            current, count = '', 0
+        current = f'{current},{part}' if current else part
+        count += end - start + 1
+    if current:
+        seqsets.append((current, count))
+    return seqsets
+
+def uid_sets(batches):
+    # Per ogni blocco di UID restituisce (blocco, insieme di sequenza); un
+    # blocco il cui insieme supera MAX_SEQUENCE_SET_LENGTH viene diviso a metà
+    for batch in batches:
+        seqsets = sequence_sets(batch)
+        if len(seqsets) == 1:
+            yield batch, seqsets[0][0]
+        else:
+            yield from uid_sets(chunks(batch, (len(batch) + 1) // 2))
+
+def count_messages(imap, charset, search_command, literal=None):
+    # SEARCH RETURN (COUNT) (RFC 4731): il server restituisce solo il numero
+    # di messaggi corrispondenti, senza la lista degli id
+    search_args = ['RETURN', '(COUNT)']
+    if charset:
+        search_args += ['CHARSET', charset]
+    imap.literal = literal
+    try:
+        res, data = imap._simple_command('SEARCH', *search_args, search_command)
+        res, data = imap._untagged_response(res, data, 'ESEARCH')
+    except imaplib.IMAP4.error:
+        return None
+    if res != 'OK' or not data or data[-1] is None:
+        return None
+    match = _ESEARCH_COUNT_RE.search(data[-1])
+    return int(match.group(1)) if match else None
+
+def confirm_header_scan(imap, count):
+    if count == 0:
+        print('Nessun messaggio corrisponde ai criteri di ricerca.')
+        imap.logout()
+        sys.exit(0)
+    if count > LARGE_SCAN_THRESHOLD:
+        answer = input(f"Trovati {count} messaggi candidati. Vuoi procedere con la scansione degli header? (s/n): ")
+        if answer.lower() != 's':
+            print('Operazione annullata.')
+            imap.logout()
+            sys.exit(0)
+
+def expunge_messages(imap, msg_uids):
+    # Con UIDPLUS (RFC 4315) si eliminano solo i messaggi indicati, senza
+    # toccare eventuali altri messaggi marcati \Deleted nella cartella
+    if not msg_uids:
+        return
+    if 'UIDPLUS' in imap.capabilities:
+        for seqset, _ in sequence_sets(msg_uids):
+            imap.uid('EXPUNGE', seqset)
+    else:
+        imap.expunge()
+
+def delete_messages(imap, msg_uids):
+    # Un solo STORE per insieme di sequenza, poi EXPUNGE dei soli messaggi indicati
+    for seqset, _ in sequence_sets(msg_uids):
+        imap.uid('STORE', seqset, '+FLAGS.SILENT', r'(\Deleted)')
+    expunge_messages(imap, msg_uids)
+
+def move_to_trash(imap, msg_uids):
+    # Con MOVE (RFC 6851) basta un comando atomico per insieme di sequenza;
+    # altrimenti COPY, e si eliminano solo i messaggi effettivamente copiati.
+    # Restituisce gli UID spostati nel cestino
+    if 'MOVE' in imap.capabilities:
+        return copy_messages(imap, msg_uids, 'Trash', command='MOVE')
+    copied = copy_messages(imap, msg_uids, 'Trash')
+    delete_messages(imap, copied)
+    return copied
+
+class MailboxUnavailableError(Exception):
+    pass
+
+def copy_messages(imap, msg_uids, destination, chunk_size=None, command='COPY'):
+    """
+    Copia (o sposta, con command='MOVE') i messaggi in destination con il
+    minor numero possibile di comandi UID COPY. Se il server rifiuta un
+    blocco, lo si ritenta in blocchi via via più piccoli per isolare i
+    messaggi che non si possono copiare; se invece rifiuta la cartella di
+    destinazione (es. inesistente) ci si ferma al primo errore.
+    Restituisce gli UID dei messaggi copiati.
+    """
+    copied = []
+    if not msg_uids:
+        return copied
+    try:
+        _copy_chunks(imap, sorted(msg_uids, key=int), destination,
+                     chunk_size or len(msg_uids), command, copied)
+    except MailboxUnavailableError as e:
+        print(f"Impossibile trasferire i messaggi in {destination}: {e}")
+    return copied
+
+def _copy_chunks(imap, msg_uids, destination, chunk_size, command, copied):
+    for chunk in chunks(msg_uids, chunk_size):
+        seqsets = sequence_sets(chunk)
+        if len(seqsets) == 1:
+            try:
+                res, data = imap.uid(command, seqsets[0][0], destination)
+            except imaplib.IMAP4.error as e:
+                res, data = 'NO', [str(e).encode()]
+            if res == 'OK':
+                copied.extend(chunk)
+                continue
+            # Un errore sulla cartella vale per tutti i messaggi: inutile ritentare
+            text = b' '.join(item for item in data if isinstance(item, bytes))
+            if _MAILBOX_ERROR_RE.search(text):
+                raise MailboxUnavailableError(text.decode(errors='replace'))
+            if len(chunk) == 1:
+                print(f"Impossibile trasferire il messaggio {chunk[0].decode()} in {destination}: {data}")
+                continue
+        _copy_chunks(imap, chunk, destination,
+                     min(COPY_RETRY_CHUNK_SIZE, (len(chunk) + 1) // 2), command, copied)
+
+def open_header_cache(path=HEADER_CACHE_PATH):
+    # Gli header contengono mittenti, destinatari e oggetti: cartella e
+    # database sono leggibili solo dall'utente
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+    os.chmod(path, 0o600)
+    cache = sqlite3.connect(path)
+    cache.execute("""
+        CREATE TABLE IF NOT EXISTS headers (
+            server TEXT NOT NULL,
+            user TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            fields TEXT NOT NULL,
+            header BLOB NOT NULL,
+            PRIMARY KEY (server, user, folder, uidvalidity, uid)
+        )""")
+    return cache
+
+def load_cached_headers(cache, server, user, folder, uidvalidity, fields):
+    """
+    Restituisce {uid: header} per i messaggi della cartella in cache che
+    contengono almeno gli header fields richiesti.
+    """
+    # Con una UIDVALIDITY diversa gli UID memorizzati non sono più validi
+    cache.execute('DELETE FROM headers WHERE server = ? AND user = ? AND folder = ? AND uidvalidity <> ?',
+                  (server, user, folder, uidvalidity))
+    wanted = set(fields)
+    rows = cache.execute('SELECT uid, fields, header FROM headers '
+                         'WHERE server = ? AND user = ? AND folder = ? AND uidvalidity = ?',
+                         (server, user, folder, uidvalidity))
+    return {str(uid).encode(): header for uid, row_fields, header in rows
+            if wanted <= set(row_fields.split())}
+
+def save_cached_headers(cache, server, user, folder, uidvalidity, fields, headers):
+    cache.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      [(server, user, folder, uidvalidity, int(uid), ' '.join(fields), header)
+                       for uid, header in headers.items()])
+
+def forget_cached_headers(cache, server, user, folder, uidvalidity, msg_uids):
+    cache.executemany('DELETE FROM headers WHERE server = ? AND user = ? AND folder = ? AND uidvalidity = ? AND uid = ?',
+                      [(server, user, folder, uidvalidity, int(uid)) for uid in msg_uids])
+    cache.commit()
+
+def cache_header_batches(header_batches, cache, cache_key, fields, cached):
+    # Salva nella cache gli header appena scaricati, man mano che arrivano
+    for batch, headers in header_batches:
+        save_cached_headers(cache, *cache_key, fields,
+                            {msg_id: header for msg_id, header in headers.items() if msg_id not in cached})
+        yield batch, headers
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def parse_fetch_response(msg_data):
+    # Le risposte FETCH arrivano come tuple (prefisso, header) seguite da b')';
+    # l'UID permette di associarle al messaggio anche se il server le
+    # restituisce in ordine diverso da quello richiesto. Alcuni server
+    # inviano l'UID dopo il literal, quindi nell'elemento successivo.
+    headers = {}
+    pending = None
+    for item in msg_data:
+        if isinstance(item, tuple):
+            match = _FETCH_UID_RE.search(item[0])
+            if match:
+                headers[match.group(1)] = item[1]
+                pending = None
+            else:
+                pending = item[1]
+        elif pending is not None and isinstance(item, bytes):
+            match = _FETCH_UID_RE.search(item)
+            if match:
+                headers[match.group(1)] = pending
+            pending = None
+    return headers
+
+def _complete_fetch(imap, tag, batch, received, debug=False):
+    try:
+        res, data = imap._command_complete('UID', tag)
+        res, msg_data = imap._untagged_response(res, data, 'FETCH')
+    except imaplib.IMAP4.error as e:
+        res, msg_data = 'BAD', [str(e).encode()]
+    if debug:
+        print(f"DEBUG: FETCH di {len(batch)} messaggi: res={res}")
+    if res != 'OK':
+        print(f"\nWarning: Impossibile recuperare gli header dei messaggi {batch[0].decode()}-{batch[-1].decode()}", flush=True)
+    else:
+        # Le risposte raccolte possono includere anche quelle dei blocchi
+        # successivi già arrivate: restano in received fino al loro turno
+        received.update(parse_fetch_response(msg_data))
+    return batch, {msg_id: received.pop(msg_id) for msg_id in batch if msg_id in received}
+
+def fetch_headers(imap, msg_ids, fetch_item, batch_size=FETCH_BATCH_SIZE, debug=False):
+    """
+    Recupera gli header dei messaggi con un comando FETCH ogni batch_size id.
+    Per ogni blocco restituisce la coppia (blocco, {msg_id: header}).
+
+    I comandi sono inviati in pipeline (RFC 3501, 5.5): fino a
+    FETCH_PIPELINE_DEPTH blocchi attendono la risposta contemporaneamente,
+    quindi finché il generatore non è esaurito non si devono inviare altri
+    comandi sulla stessa connessione.
+    """
+    pending = deque()
+    received = {}
+    for batch, seqset in uid_sets(chunks(msg_ids, batch_size)):
+        tag = imap._command('UID', 'FETCH', seqset, fetch_item)
+        pending.append((tag, batch))
+        if len(pending) >= FETCH_PIPELINE_DEPTH:
+            yield _complete_fetch(imap, *pending.popleft(), received, debug)
+    while pending:
+        yield _complete_fetch(imap, *pending.popleft(), received, debug)
+
+def fetch_message_sizes(imap, msg_ids):
+    # Restituisce {uid: dimensione in byte} con un FETCH RFC822.SIZE per
+    # insieme di sequenza; i messaggi senza risposta non compaiono
+    sizes = {}
+    for seqset, _ in sequence_sets(msg_ids):
+        try:
+            res, data = imap.uid('FETCH', seqset, '(RFC822.SIZE)')
+        except imaplib.IMAP4.error:
+            continue
+        if res != 'OK':
+            continue
+        for item in data:
+            if isinstance(item, bytes):
+                uid = _FETCH_UID_RE.search(item)
+                size = _FETCH_SIZE_RE.search(item)
+                if uid and size:
+                    sizes[uid.group(1)] = int(size.group(1))
+    return sizes
+
+def size_batches(msg_ids, sizes, batch_size, batch_bytes):
+    # Divide gli id in blocchi di al più batch_size messaggi e batch_bytes
+    # byte complessivi; un messaggio di dimensione ignota forma un blocco a sé
+    batch, total = [], 0
+    for msg_id in msg_ids:
+        size = sizes.get(msg_id, batch_bytes)
+        if batch and (len(batch) >= batch_size or total + size > batch_bytes):
+            yield batch
+            batch, total = [], 0
+        batch.append(msg_id)
+        total += size
+    if batch:
+        yield batch
+
+def fetch_messages(imap, msg_ids, batch_size=ARCHIVE_FETCH_BATCH_SIZE, batch_bytes=ARCHIVE_FETCH_BATCH_BYTES):
+    # Scarica i messaggi completi con un FETCH per blocco, limitando sia il
+    # numero di messaggi sia la loro dimensione complessiva: in memoria resta
+    # al più un blocco. A differenza di fetch_headers i comandi non sono in
+    # pipeline: tra un blocco e l'altro si possono inviare altri comandi
+    # (APPEND) sulla stessa connessione
+    sizes = fetch_message_sizes(imap, msg_ids)
+    for batch, seqset in uid_sets(size_batches(msg_ids, sizes, batch_size, batch_bytes)):
+        try:
+            res, msg_data = imap.uid('FETCH', seqset, '(BODY.PEEK[])')
+        except imaplib.IMAP4.error:
+            res, msg_data = 'NO', []
+        bodies = parse_fetch_response(msg_data) if res == 'OK' else {}
+        # La risposta grezza non deve restare nel frame del generatore durante
+        # lo yield: l'unico riferimento ai corpi resta bodies, da cui il
+        # chiamante li rimuove uno alla volta
+        del msg_data
+        yield batch, bodies
+
+def produce_headers(imap, msg_ids, fetch_item, batch_size, results, debug=False):
+    # Eseguita in un thread produttore: mette nella coda results i blocchi
+    # (blocco, {msg_id: header}) e per ultimo (None, id non scaricati)
+    delivered = 0
+    try:
+        for batch, headers in fetch_headers(imap, msg_ids, fetch_item, batch_size, debug):
+            results.put((batch, headers))
+            delivered += len(batch)
+    except (imaplib.IMAP4.error, OSError) as e:
+        print(f"\nErrore durante il recupero degli header: {e}", flush=True)
+    finally:
+        results.put((None, msg_ids[delivered:]))
+
+def fetch_headers_shard(server, user, password, folder, msg_ids, fetch_item, batch_size, results, debug=False):
+    # Eseguita in un thread produttore: usa una connessione dedicata con la
+    # cartella aperta in sola lettura, per non interferire con quella principale
+    try:
+        imap = connect_imap(server, user, password)
+    except (SystemExit, OSError):
+        results.put((None, msg_ids))
+        return
+    try:
+        res, data = imap.select(folder, readonly=True)
+    except (imaplib.IMAP4.error, OSError):
+        res = 'NO'
+    if res == 'OK':
+        produce_headers(imap, msg_ids, fetch_item, batch_size, results, debug)
+    else:
+        results.put((None, msg_ids))
+    try:
+        imap.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
+
+def scan_headers(imap, args, folder, msg_ids, fetch_item, batch_size=FETCH_BATCH_SIZE):
+    """
+    Recupera gli header dei messaggi e restituisce le coppie
+    (blocco, {msg_id: header}) man mano che arrivano.
+
+    Il download avviene in thread produttori, così il thread principale
+    analizza un blocco mentre i successivi sono ancora in transito. Con più
+    connessioni (args.connections) gli id sono divisi in blocchi contigui,
+    ciascuno scaricato da una connessione aggiuntiva.
+    """
+    connections = min(args.connections, -(-len(msg_ids) // batch_size))
+    results = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    if connections <= 1:
+        producers = [threading.Thread(target=produce_headers, daemon=True,
+                                      args=(imap, msg_ids, fetch_item, batch_size, results, args.debug))]
+    else:
+        shard_size = -(-len(msg_ids) // connections)
+        producers = [threading.Thread(target=fetch_headers_shard, daemon=True,
+                                      args=(args.server, args.user, args.password, folder, shard,
+                                            fetch_item, batch_size, results, args.debug))
+                     for shard in chunks(msg_ids, shard_size)]
+    for producer in producers:
+        producer.start()
+
+    running = len(producers)
+    missing = []
+    last_command = time.monotonic()
+    while running:
+        if connections > 1 and time.monotonic() - last_command >= KEEPALIVE_INTERVAL:
+            # La connessione principale resta inattiva durante lo scaricamento:
+            # un NOOP evita che il server la chiuda per timeout
+            imap.noop()
+            last_command = time.monotonic()
+        try:
+            batch, headers = results.get(timeout=KEEPALIVE_INTERVAL)
+        except queue.Empty:
+            continue
+        if batch is not None:
+            yield batch, headers
+            continue
+        running -= 1
+        if headers:
+            missing.append(headers)
+    for producer in producers:
+        producer.join()
+
+    for remaining in missing:
+        if connections <= 1:
+            # La connessione principale non ha risposto: gli header mancanti
+            # vengono segnalati come non recuperabili
+            yield remaining, {}
+            continue
+        # La connessione aggiuntiva non è disponibile (es. limite di
+        # connessioni del server): si usa quella principale, ormai libera
+        print("\nWarning: Connessione aggiuntiva non riuscita, uso la connessione principale", flush=True)
+        yield from fetch_headers(imap, remaining, fetch_item, batch_size, args.debug)
 
 def main():
     
@@ -474,6 +1473,21 @@ def main():
     and_headers = args.and_header or []
     or_headers = args.or_header or []
 
+    # Le condizioni che il server verifica già con SEARCH non vengono
+    # riapplicate e i relativi header non vengono scaricati
+    client_and_headers = [(header, regex) for header, regex in and_headers
+                          if not is_exact_server_filter(header, regex)]
+    client_or_headers = or_headers
+    if all(is_exact_server_filter(header, regex) for header, regex in or_headers):
+        client_or_headers = []
+
+    # Compila una sola volta le espressioni regolari usate nel ciclo di ricerca
+    try:
+        classifier = HeaderClassifier(args.regex, client_and_headers, client_or_headers, args.debug)
+    except re.error as e:
+        print(f'Espressione regolare non valida: {e}')
+        sys.exit(1)
+
     imap = connect_imap(args.server, args.user, args.password)
 
     if args.list:
@@ -496,13 +1510,15 @@ def main():
             print("Impossibile ottenere il namespace dal server IMAP.")
 
     folder_name = args.folder.replace('"', '') # gestisce caratteri speciali nel nome folder
+    selected_folder = folder_name
     try:
-        res, data = imap.select(folder_name)
+        res, data = imap.select(selected_folder)
     except imaplib.IMAP4.error as e:
         print(f'Errore nella selezione della cartella: {e}')
         print('Provo a utilizzare il nome della cartella tra virgolette...')
+        selected_folder = f'"{folder_name}"'
         try:
-            res, data = imap.select(f'"{folder_name}"')
+            res, data = imap.select(selected_folder)
         except imaplib.IMAP4.error as e:
             print(f'Errore nella selezione della cartella: {e}')
             print('Impossibile selezionare la cartella. Verificare il nome e i permessi.')
@@ -514,6 +1530,7 @@ def main():
         print(f'Errore: {data[0].decode()}')
         imap.logout()
         sys.exit(1)
+    _, uidvalidity = imap.response('UIDVALIDITY')
 
     search_criteria = []
 
@@ -524,83 +1541,163 @@ def main():
         search_criteria.append(f'SINCE {start_str}')
         search_criteria.append(f'BEFORE {end_str}')
 
-    if args.regex:
-        pass  # Il filtro per la regex sarà applicato successivamente
+    # Le regex che sono semplici sottostringhe vengono passate al server, che
+    # restituisce solo i messaggi candidati; le regex ancorate o non ASCII
+    # vengono comunque riapplicate sugli header scaricati. Date resta escluso:
+    # i filtri lo confrontano nel formato normalizzato di get_header_value,
+    # il server sul valore grezzo dell'header
+    server_filters = []
+    subject_literal = literal_pattern(args.regex)
+    if subject_literal:
+        server_filters.append(('SUBJECT', subject_literal))
+    for header, regex in and_headers:
+        header_literal = literal_pattern(regex)
+        if header_literal and header.lower() != 'date':
+            server_filters.append((f'HEADER {imap_quote(header)}', header_literal))
+
+    search_literal = None
+    for key, value in server_filters:
+        if value.isascii():
+            search_criteria.append(f'{key} {imap_quote(value)}')
+        elif search_literal is None:
+            # imaplib invia un solo literal per comando, in coda agli altri criteri
+            search_literal = (key, value.encode('utf-8'))
+
+    # Le condizioni OR si passano al server solo se sono tutte sottostringhe:
+    # OR HEADER a "x" OR HEADER b "y" HEADER c "z"
+    or_literals = [literal_pattern(regex) for _, regex in or_headers]
+    if or_headers and all(value and value.isascii() for value in or_literals) and \
+            all(header.lower() != 'date' for header, _ in or_headers):
+        or_keys = [f'HEADER {imap_quote(header)} {imap_quote(value)}'
+                   for (header, _), value in zip(or_headers, or_literals)]
+        or_criterion = or_keys[-1]
+        for key in reversed(or_keys[:-1]):
+            or_criterion = f'OR {key} {or_criterion}'
+        search_criteria.append(or_criterion)
+
+    charset = None
+    literal = None
+    if search_literal:
+        search_criteria.append(search_literal[0])
+        literal = search_literal[1]
+        charset = 'UTF-8'
 
     # Costruisce la stringa di ricerca per il comando SEARCH
     search_command = 'ALL'
     if search_criteria:
         search_command = ' '.join(search_criteria)
-
-    res, messages = imap.search(None, search_command)
+    if args.debug:
+        print(f"DEBUG: Criteri di ricerca: {search_command}")
+
+    # Se il server supporta ESEARCH si chiede prima solo il numero dei
+    # messaggi, per poter annullare prima di trasferire id e header
+    candidates = None
+    if 'ESEARCH' in imap.capabilities:
+        candidates = count_messages(imap, charset, search_command, literal)
+        if args.debug:
+            print(f"DEBUG: Messaggi candidati (ESEARCH): {candidates}")
+        if candidates is not None:
+            confirm_header_scan(imap, candidates)
+
+    # Tutti i comandi successivi usano gli UID, che a differenza dei numeri di
+    # sequenza non cambiano quando altri messaggi vengono eliminati
+    imap.literal = literal
+    if charset:
+        res, messages = imap.uid('SEARCH', 'CHARSET', charset, search_command)
+    else:
+        res, messages = imap.uid('SEARCH', search_command)
     if res != 'OK':
         print('Errore nella ricerca dei messaggi.')
         imap.logout()
         sys.exit(1)
 
     msg_ids = messages[0].split()
+    if candidates is None:
+        confirm_header_scan(imap, len(msg_ids))
 
     print('Ricerca dei messaggi in corso...')
     total_msgs = len(msg_ids)
     filtered_msgs = []
     non_matching = 0
 
-    for idx, msg_id in enumerate(msg_ids, 1):
-        try:
-            res, msg_data = imap.fetch(msg_id, '(RFC822.HEADER)')
-            if res != 'OK' or not msg_data or msg_data[0] is None:
-                print(f"\nWarning: Impossibile recuperare l'header completo per il messaggio ID {msg_id.decode()} (Indice: {idx}/{total_msgs})")
-                # Tentiamo di recuperare gli header disponibili
-                try:
-                    res, msg_data = imap.fetch(msg_id, '(BODY[HEADER.FIELDS (FROM TO SUBJECT DATE)])')
-                    if res == 'OK' and msg_data and msg_data[0] is not None:
-                        print("Header disponibili:")
-                        header_data = msg_data[0][1].decode('utf-8', errors='ignore')
-                        print(header_data)
-                    else:
-                        print("Impossibile recuperare gli header di base.")
-                except Exception as e:
-                    print(f"Errore nel tentativo di recuperare gli header di base: {str(e)}")
-                continue
-
-            header_data = msg_data[0][1]
-            if header_data is None:
-                print(f"\nWarning: Dati dell'header mancanti per il messaggio ID {msg_id}")
-                continue
-
-            try:
-                header_data = header_data.decode('utf-8', errors='ignore')
-            except AttributeError:
-                print(f"\nWarning: Dati dell'header mancanti per il messaggio ID {msg_id.decode()} (Indice: {idx}/{total_msgs})")
-                continue
-
-            # Verifica le condizioni AND
-            and_match = all(re.search(regex, get_header_value(header_data, header), re.IGNORECASE)
-                            for header, regex in and_headers)
-
-            # Verifica le condizioni OR
-            or_match = any(re.search(regex, get_header_value(header_data, header), re.IGNORECASE)
-                        for header, regex in or_headers) if or_headers else True
-
-            subject = get_header_value(header_data, 'Subject')
-
-            if (and_match and or_match) and (not args.regex or re.search(args.regex, subject, re.IGNORECASE)):
-                filtered_msgs.append((msg_id, subject,get_header_value(header_data, 'Date')))
-            else:
+    # Si scaricano solo gli header usati dai filtri e per il riepilogo;
+    # BODY.PEEK non imposta il flag \Seen sui messaggi letti
+    fields = sorted({'SUBJECT', 'DATE'} | {header.upper() for header, _ in client_and_headers + client_or_headers})
+    if args.cache:
+        fields = sorted(set(fields) | set(CACHED_HEADER_FIELDS))
+    fetch_item = f'(BODY.PEEK[HEADER.FIELDS ({" ".join(fields)})])'
+
+    idx = 0
+    next_draw = 0.0
+    if hasattr(signal, 'SIGWINCH'):
+        signal.signal(signal.SIGWINCH, _reset_terminal_width)
+
+    # Con --cache gli header già scaricati in esecuzioni precedenti vengono
+    # letti dal disco e dal server si scaricano solo quelli mancanti
+    cache = None
+    cached = {}
+    if args.cache and uidvalidity and uidvalidity[0]:
+        cache_key = (args.server, args.user, folder_name, int(uidvalidity[0]))
+        cache = open_header_cache()
+        cached = load_cached_headers(cache, *cache_key, fields)
+        if args.debug:
+            print(f"DEBUG: Header presenti nella cache: {len(cached)}")
+    header_batches = scan_headers(imap, args, selected_folder, [msg_id for msg_id in msg_ids if msg_id not in cached],
+                                  fetch_item, args.fetch_batch_size)
+    if cached:
+        cached_ids = [msg_id for msg_id in msg_ids if msg_id in cached]
+        header_batches = itertools.chain(((batch, {msg_id: cached[msg_id] for msg_id in batch})
+                                          for batch in chunks(cached_ids, args.fetch_batch_size)),
+                                         header_batches)
+
+    if cache is not None:
+        header_batches = cache_header_batches(header_batches, cache, cache_key, fields, cached)
+
+    # Con --parse-workers l'analisi degli header avviene in processi separati
+    executor = None
+    if args.parse_workers:
+        executor = ProcessPoolExecutor(args.parse_workers, initializer=_init_parse_worker,
+                                       initargs=(args.regex, client_and_headers, client_or_headers, args.debug))
+        # I processi vengono creati subito, prima dei thread che scaricano gli header
+        executor.submit(int).result()
+
+    for batch, results in classify_batches(header_batches, classifier, executor, 2 * args.parse_workers):
+        for msg_id, result in zip(batch, results):
+            idx += 1
+            outcome = result[0]
+            if outcome == 'match':
+                filtered_msgs.append((msg_id, result[1], result[2]))
+            elif outcome == 'nomatch':
+                non_matching += 1
+            elif outcome == 'missing':
+                print(f"\nWarning: Impossibile recuperare l'header per il messaggio ID {msg_id.decode()} (Indice: {idx}/{total_msgs})", flush=True)
+            elif outcome == 'timeout':
+                print(f"\nWarning: Valutazione delle regex troppo lenta per il messaggio ID {msg_id.decode()}, messaggio scartato", flush=True)
                 non_matching += 1
+            else:
+                print(f"\nErrore durante l'elaborazione del messaggio ID {msg_id.decode()} (Indice: {idx}/{total_msgs}): {result[1]}", flush=True)
 
-        except Exception as e:
-            print(f"\nErrore durante l'elaborazione del messaggio ID {msg_id.decode()} (Indice: {idx}/{total_msgs}): {str(e)}")
+        # Aggiorna la barra di avanzamento al più una volta per blocco e al più
+        # 10 volte al secondo
+        now = time.monotonic()
+        if now < next_draw and idx != total_msgs:
             continue
-
-        # Aggiorna la barra di avanzamento
+        next_draw = now + PROGRESS_REDRAW_INTERVAL
         matching = len(filtered_msgs)
-        progress_bar = create_progress_bar(total_msgs, idx, matching, non_matching)
-        print(f'\r{progress_bar}', end='', flush=True)
+        progress_bar = create_progress_bar(total_msgs, idx, matching, non_matching, terminal_width())
+        # La barra è scritta direttamente sul buffer di stdout; i messaggi
+        # stampati durante la ricerca usano flush=True per mantenere l'ordine
+        # dell'output
+        sys.stdout.buffer.write(progress_bar)
+        sys.stdout.buffer.flush()
         # Fine ciclo for
         
         
+    if executor is not None:
+        executor.shutdown()
     print('\n')  # Nuova linea dopo la barra di avanzamento
+    if cache is not None:
+        cache.commit()
     num_msgs = len(filtered_msgs)
     print(f'Numero di messaggi trovati: {num_msgs}')
 
@@ -619,46 +1716,68 @@ def main():
         imap.logout()
         sys.exit(0)
 
+    # Gli UID trovati valgono solo se nel frattempo la cartella non è stata
+    # ricreata sul server (UIDVALIDITY invariato)
+    res, data = imap.select(selected_folder)
+    _, current_uidvalidity = imap.response('UIDVALIDITY')
+    if res != 'OK' or current_uidvalidity != uidvalidity:
+        print('La cartella è stata modificata sul server (UIDVALIDITY diverso): operazione annullata.')
+        imap.logout()
+        sys.exit(1)
+
     if args.archive or args.archive_to_disk:
         archive_dest = args.archive or args.archive_to_disk
         print(f"Archiviazione dei messaggi in {archive_dest}...")
-        for idx, msg_id in enumerate(messages_to_delete, 1):
-            if args.archive:
-                success = archive_message_imap(imap, msg_id, args.archive, args.folder, args.user, args.debug)
-            else:
-                success = archive_message_disk(msg_id, imap, args.archive_to_disk, args.folder, args.debug)
-            
-            if success:
-                if args.archive:
-                    imap.store(msg_id, '+FLAGS', r'(\Deleted)')
-                elif args.expunge:
-                    imap.store(msg_id, '+FLAGS', r'(\Deleted)')
+        if args.archive:
+            prewarm_folder_cache(imap)
+        # I messaggi vengono scaricati a blocchi; COPY nel cestino e STORE sono
+        # inviati alla fine con un solo comando per insieme di sequenza
+        archived = []
+        idx = 0
+        for batch, bodies in fetch_messages(imap, messages_to_delete):
+            for msg_id in batch:
+                idx += 1
+                # Il corpo viene rilasciato appena archiviato: in memoria resta
+                # al più un blocco di messaggi
+                email_body = bodies.pop(msg_id, None)
+                if email_body is None:
+                    print(f"Errore nel recupero del messaggio {msg_id}")
+                    success = False
+                elif args.archive:
+                    success = archive_message_imap(imap, msg_id, email_body, args.archive, args.folder, args.user, args.debug)
                 else:
-                    res = imap.copy(msg_id, 'Trash')
-                    if res[0] == 'OK':
-                        imap.store(msg_id, '+FLAGS', r'(\Deleted)')
-            else:
-                print (f"messaggio id {msg_id.decode()} non trasferito.")
-             
-            if idx % 10 == 0 or idx == len(messages_to_delete):
-                print(f'{idx}/{len(messages_to_delete)} messaggi elaborati.')
-        imap.expunge()
+                    success = archive_message_disk(msg_id, email_body, args.archive_to_disk, args.folder, args.debug)
+
+                if success:
+                    archived.append(msg_id)
+                else:
+                    print (f"messaggio id {msg_id.decode()} non trasferito.")
+
+                if idx % 10 == 0 or idx == len(messages_to_delete):
+                    print(f'{idx}/{len(messages_to_delete)} messaggi elaborati.')
+
+        if args.archive or args.expunge:
+            delete_messages(imap, archived)
+        else:
+            move_to_trash(imap, archived)
         print('Archiviazione completata.')
     else:
         print('Cancellazione in corso...')
-        for idx, msg_id in enumerate(messages_to_delete, 1):
-            if args.expunge:
-                imap.store(msg_id, '+FLAGS', r'(\Deleted)')
-            else:
-                res = imap.copy(msg_id, 'Trash')
-                if res[0] == 'OK':
-                    imap.store(msg_id, '+FLAGS', r'(\Deleted)')
-            if idx % 10 == 0 or idx == len(messages_to_delete):
-                print(f'{idx}/{len(messages_to_delete)} messaggi elaborati.')
-        imap.expunge()
+        # Un solo comando per insieme di sequenza invece di uno per messaggio
+        if args.expunge:
+            deleted = messages_to_delete
+            delete_messages(imap, deleted)
+        else:
+            deleted = move_to_trash(imap, messages_to_delete)
+        print(f'{len(deleted)}/{len(messages_to_delete)} messaggi elaborati.')
         print('Cancellazione completata.')
         total_msgs = len(messages_to_delete)
 
+    if cache is not None:
+        # I messaggi elaborati non sono più nella cartella
+        forget_cached_headers(cache, *cache_key, messages_to_delete)
+        cache.close()
+
         
         
     imap.logout()